@@ -29,6 +29,18 @@ def test_mnist_single() -> None:
         assert base_model.test_metrics[metric] > limit
 
 
+def test_mnist_fast_train() -> None:
+    """ Trains a single model on MNIST with the custom fast_train loop """
+    params = tp.config.load_parameters(MNIST_PARAMS_FILE)
+    params.fast_train = True
+    params.fast_train_steps = 8
+    data = tp.data.Dataset(src_dir=params.dataset, **params.__dict__)
+    base_model = tp.model.Model(params=params)
+    base_model.fit(data=data)
+    for metric, limit in METRICS_TO_CHECK.items():
+        assert base_model.test_metrics[metric] > limit
+
+
 def test_mnist_bagging() -> None:
     """ Loads parameters to train a bagging Ensemble on MNIST """
     params = tp.config.load_parameters(MNIST_PARAMS_FILE)
@@ -41,4 +53,5 @@ def test_mnist_bagging() -> None:
 if __name__ == "__main__":
     test_download_mnist()
     test_mnist_bagging()
-    test_mnist_single()
\ No newline at end of file
+    test_mnist_single()
+    test_mnist_fast_train()
\ No newline at end of file
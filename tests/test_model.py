@@ -0,0 +1,114 @@
+import json
+import yaml
+import numpy as np
+import tensorflow as tf
+import toupee as tp
+
+
+def _write_model(tmp_path, keras_model) -> str:
+    model_file = str(tmp_path / 'test.model')
+    with open(model_file, 'w') as f:
+        yaml.dump(json.loads(keras_model.to_json()), f)
+    return model_file
+
+
+def _dense_model() -> tf.keras.Model:
+    inputs = tf.keras.Input(shape=(4,), name='input')
+    hidden = tf.keras.layers.Dense(8, activation='relu', name='hidden')(inputs)
+    normalized = tf.keras.layers.BatchNormalization(name='normalized')(hidden)
+    outputs = tf.keras.layers.Dense(3, activation='softmax', name='output')(normalized)
+    return tf.keras.Model(inputs=inputs, outputs=outputs, name='dense')
+
+
+def _model(tmp_path, **params) -> tp.model.Model:
+    params = dict(tp.config.defaults,
+                  model_file=_write_model(tmp_path, _dense_model()),
+                  optimizer={'class_name': 'SGD', 'config': {'learning_rate': 0.1}},
+                  loss='categorical_crossentropy',
+                  epochs=1,
+                  batch_size=4,
+                  **params)
+    return tp.model.Model(params=tp.parameters.Parameters(**params))
+
+
+def _assert_same_weights(model, other_model) -> None:
+    for weight, other_weight in zip(model.get_weights(), other_model.get_weights()):
+        np.testing.assert_array_equal(weight, other_weight)
+
+
+def test_load_h5_weights(tmp_path) -> None:
+    """ HDF5 weights load the same both when read from the file and from the cache """
+    source = _model(tmp_path).get_keras_model()
+    source.set_weights([np.random.rand(*w.shape) for w in source.get_weights()])
+    weights_file = str(tmp_path / 'weights.h5')
+    source.save_weights(weights_file)
+    tp.model._WEIGHTS_CACHE.clear()
+    for _ in range(2):
+        model = _model(tmp_path, model_weights=weights_file)
+        _assert_same_weights(model.get_keras_model(), source)
+    assert len(tp.model._WEIGHTS_CACHE) == 1
+
+
+def test_predict(tmp_path) -> None:
+    """ Predictions match Keras for arrays, lists and datasets, including empty ones """
+    model = _model(tmp_path, xla=False)
+    X = np.random.rand(10, 4).astype(np.float32)
+    expected = model.get_keras_model().predict(X)
+    np.testing.assert_allclose(model.predict_proba(X), expected, rtol=1e-5)
+    np.testing.assert_allclose(model.predict_proba(X.tolist()), expected, rtol=1e-5)
+    dataset = tf.data.Dataset.from_tensor_slices(X).batch(4)
+    np.testing.assert_allclose(model.predict_proba(dataset), expected, rtol=1e-5)
+    np.testing.assert_array_equal(model.predict_classes(X), np.argmax(expected, axis=1))
+    assert model.predict_proba(X[:0]).shape == (0, 3)
+    assert model.predict_proba(dataset.take(0)).shape == (0, 3)
+    assert model.predict_classes(X[:0]).shape == (0,)
+
+
+def test_inject_layers_keeps_weights(tmp_path) -> None:
+    """ Injecting layers that keep the shape of their predecessor reuses the existing layers """
+    model = _model(tmp_path)
+    old_layers = {layer.name: layer for layer in model.get_keras_model().layers}
+    old_weights = {name: layer.get_weights() for name, layer in old_layers.items()}
+    new_layer = model.inject_layers([{'class_name': 'Dense',
+                                      'name': 'extra',
+                                      'config': {'name': 'extra', 'units': 8},
+                                      'inbound_nodes': [[['PREDECESSOR', 0, 0, {}]]]}],
+                                    'hidden')
+    keras_model = model.get_keras_model()
+    assert keras_model.get_layer(new_layer).output_shape == (None, 8)
+    for name, layer in old_layers.items():
+        assert keras_model.get_layer(name) is layer
+        for weight, old_weight in zip(layer.get_weights(), old_weights[name]):
+            np.testing.assert_array_equal(weight, old_weight)
+    assert model.predict_proba(np.zeros((2, 4))).shape == (2, 3)
+
+
+def test_inject_layers_new_shape(tmp_path) -> None:
+    """ Injecting layers that change the shape of their predecessor rebuilds the model """
+    model = _model(tmp_path)
+    new_layer = model.inject_layers([{'class_name': 'Dense',
+                                      'name': 'branch',
+                                      'config': {'name': 'branch', 'units': 4},
+                                      'inbound_nodes': [[['PREDECESSOR', 0, 0, {}]]]},
+                                     {'class_name': 'Concatenate',
+                                      'name': 'concat',
+                                      'config': {'name': 'concat'},
+                                      'inbound_nodes': [[['PREDECESSOR', 0, 0, {}],
+                                                         ['branch', 0, 0, {}]]]}],
+                                    'hidden')
+    keras_model = model.get_keras_model()
+    assert keras_model.get_layer(new_layer).output_shape == (None, 12)
+    assert keras_model.get_layer('normalized').input_shape == (None, 12)
+    assert model.predict_proba(np.zeros((2, 4))).shape == (2, 3)
+
+
+def test_save_inference_only(tmp_path) -> None:
+    """ An inference-only SavedModel serves the same outputs as predict_proba """
+    model = _model(tmp_path)
+    X = np.random.rand(5, 4).astype(np.float32)
+    saved_model_dir = str(tmp_path / 'saved_model')
+    model.save(saved_model_dir, inference_only=True)
+    serve = tf.saved_model.load(saved_model_dir).signatures['serving_default']
+    outputs = list(serve(tf.constant(X)).values())
+    assert len(outputs) == 1
+    np.testing.assert_allclose(outputs[0].numpy(), model.predict_proba(X), rtol=1e-5)
@@ -0,0 +1,54 @@
+import os
+import json
+import yaml
+import toupee as tp
+
+
+CONFIGURATION = {'class_name': 'Model', 'config': {'name': 'original', 'layers': []}}
+CHANGED_CONFIGURATION = {'class_name': 'Model', 'config': {'name': 'changed', 'layers': []}}
+
+
+def _write_model_file(tmp_path, configuration) -> str:
+    model_file = str(tmp_path / 'test.model')
+    with open(model_file, 'w') as f:
+        yaml.dump(configuration, f)
+    return model_file
+
+
+def test_cache_file_written(tmp_path) -> None:
+    """ The first load writes a json cache file that later loads use """
+    tp.model._YAML_CACHE.clear()
+    model_file = _write_model_file(tmp_path, CONFIGURATION)
+    assert tp.model._load_model_config(model_file) == CONFIGURATION
+    with open(model_file + '.cache.json') as f:
+        assert json.load(f)['configuration'] == CONFIGURATION
+    tp.model._YAML_CACHE.clear()
+    assert tp.model._load_model_config(model_file) == CONFIGURATION
+
+
+def test_stale_cache_file(tmp_path) -> None:
+    """ A yaml replaced by one with an older mtime is not served from the cache file """
+    tp.model._YAML_CACHE.clear()
+    model_file = _write_model_file(tmp_path, CONFIGURATION)
+    tp.model._load_model_config(model_file)
+    cache_mtime = os.stat(model_file + '.cache.json').st_mtime
+    _write_model_file(tmp_path, CHANGED_CONFIGURATION)
+    os.utime(model_file, (cache_mtime - 100, cache_mtime - 100))
+    tp.model._YAML_CACHE.clear()
+    assert tp.model._load_model_config(model_file) == CHANGED_CONFIGURATION
+
+
+def test_corrupt_cache_file(tmp_path) -> None:
+    """ A truncated cache file is ignored and rewritten """
+    tp.model._YAML_CACHE.clear()
+    model_file = _write_model_file(tmp_path, CONFIGURATION)
+    tp.model._load_model_config(model_file)
+    cache_file = model_file + '.cache.json'
+    with open(cache_file) as f:
+        contents = f.read()
+    with open(cache_file, 'w') as f:
+        f.write(contents[:len(contents) // 2])
+    tp.model._YAML_CACHE.clear()
+    assert tp.model._load_model_config(model_file) == CONFIGURATION
+    with open(cache_file) as f:
+        assert json.load(f)['configuration'] == CONFIGURATION
@@ -0,0 +1,33 @@
+import toupee as tp
+
+
+SCHEDULE = {2: {'class_name': 'Adam',
+                'config': {'learning_rate': {5: 0.01, 3: 0.1}}},
+            10: {'class_name': 'SGD',
+                 'config': {'learning_rate': 0.5}}}
+
+
+def test_optimizer_thresholds() -> None:
+    """ Each epoch gets the optimizer of the last threshold it has reached """
+    schedule = tp.model.OptimizerSchedule(SCHEDULE, epochs=20)
+    assert schedule[0] is None
+    assert schedule[1] is None
+    for epoch in range(2, 10):
+        assert schedule[epoch] is schedule.optimizers[2]
+    for epoch in range(10, 20):
+        assert schedule[epoch] is schedule.optimizers[10]
+
+
+def test_learning_rate_thresholds() -> None:
+    """ Learning rates follow both the optimizer and the inner learning_rate thresholds """
+    schedule = tp.model.OptimizerSchedule(SCHEDULE, epochs=20)
+    expected = {0: None, 1: None, 2: None, 3: 0.1, 4: 0.1, 5: 0.01, 9: 0.01, 10: 0.5, 19: 0.5}
+    for epoch, lr in expected.items():
+        assert schedule.learning_rate(epoch) == lr
+
+
+def test_single_optimizer() -> None:
+    """ An optimizer spec without thresholds applies from epoch 0 """
+    schedule = tp.model.OptimizerSchedule({'class_name': 'SGD', 'config': {'learning_rate': 0.5}}, epochs=5)
+    assert schedule[0] is schedule.optimizers[0]
+    assert schedule.learning_rate(4) == 0.5
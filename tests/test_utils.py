@@ -0,0 +1,18 @@
+import toupee as tp
+
+
+def test_replace_inbound_layer() -> None:
+    """ Inbound layers are renamed according to the mapping, others are left alone """
+    inbound_nodes = [[['PREDECESSOR', 0, 0, {}],
+                      ['conv2d_38', 0, 0, {}],
+                      ['dense_1', 0, 0, {}]]]
+    replaced = tp.utils.replace_inbound_layer(inbound_nodes, {'PREDECESSOR': 'concatenate_34',
+                                                              'conv2d_38': 'autogenerated-conv2d_38'})
+    assert replaced == [[['concatenate_34', 0, 0, {}],
+                         ['autogenerated-conv2d_38', 0, 0, {}],
+                         ['dense_1', 0, 0, {}]]]
+
+
+def test_replace_inbound_layer_no_inputs() -> None:
+    """ Layers without inbound nodes, like inputs, are unchanged """
+    assert tp.utils.replace_inbound_layer([], {'PREDECESSOR': 'input_1'}) == []
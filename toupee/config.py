@@ -32,6 +32,10 @@ defaults = {'shuffle_dataset': False,
             'reduce_lr_on_plateau': None,
             'verbose': 1,
             'multi_gpu': False,
+            'xla': True,
+            'precision': 'fp32',
+            'fast_train': False,
+            'fast_train_steps': 1,
            }
 
 
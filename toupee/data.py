@@ -91,7 +91,7 @@ def _np_to_tf(data:tuple, batch_size:int, shuffle:bool=False, shuffle_buffer:int
     if shuffle and not gen_flow: # gen_flow already does shuffling
         shuffle_buffer = shuffle_buffer or data[0].shape[0]
         dataset = dataset.shuffle(shuffle_buffer)
-    return dataset
+    return dataset.prefetch(tf.data.AUTOTUNE)
 
 
 def convert_to_tf(data:tuple, data_format:str, **kwargs):
@@ -152,7 +152,13 @@ class EnsembleMethod:
 
     def raw_predict_proba(self, X):
         """ Returns all the predictions from all Ensemble members """
-        return np.array([m.predict_proba(X) for m in self.members[:self._fit_loop_info['current_step'] + 1]])
+        members = self.members[:self._fit_loop_info['current_step'] + 1]
+        # members trained on the same data share an img_gen, so X only needs standardizing once
+        img_gen = members[0].img_gen
+        if img_gen and all(m.img_gen is img_gen for m in members):
+            X = img_gen.standardize(np.copy(X))
+            return np.array([m.predict_proba(X, already_standardized=True) for m in members])
+        return np.array([m.predict_proba(X) for m in members])
 
     def predict_proba(self, X):
         """ Return predicted soft probability outputs for the aggregate """
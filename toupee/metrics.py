@@ -61,8 +61,10 @@ def evaluate(model, test_data, adversarial_gradient_source=None):
     all_adversarial = []
     for (x, y_true) in test_data:
         all_x.append(x)
-        all_y_pred.append(model.predict_classes(x))
-        all_y_pred_onehot.append(model.predict_proba(x))
+        # a single forward pass gives both the probabilities and the classes
+        y_pred_onehot = model.predict_proba(x)
+        all_y_pred.append(np.argmax(y_pred_onehot, axis=1))
+        all_y_pred_onehot.append(y_pred_onehot)
         all_y_true.append(np.argmax(y_true.numpy(), axis=1))
         all_y_true_onehot.append(y_true.numpy())
         if adversarial_gradient_source:
@@ -79,8 +81,8 @@ def evaluate(model, test_data, adversarial_gradient_source=None):
         adversarial_scores = {}
         for epsilon in tp.ADVERSARIAL_EPSILONS:
             adversarial_x = x + epsilon * adversarial_perturbation
-            y_adv = model.predict_classes(adversarial_x)
             y_adv_onehot = model.predict_proba(adversarial_x)
+            y_adv = np.argmax(y_adv_onehot, axis=1)
             adversarial_scores[str(epsilon)] = tp.utils.eval_scores(y_true, y_adv, y_true_onehot, y_adv_onehot)
         scores['adversarial'] = adversarial_scores
     return scores
\ No newline at end of file
@@ -10,14 +10,20 @@ All code released under Apachev2.0 licensing.
 """
 __docformat__ = 'restructedtext en'
 
+import os
 import time
+import bisect
 import copy
 import logging
 import tensorflow as tf # type: ignore
 import numpy as np # type: ignore
+import h5py # type: ignore
 import uuid
 import yaml
 import json
+import tempfile
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 try:
     from yaml import CLoader as YLoader
@@ -31,6 +37,188 @@ import toupee as tp
 #TODO: early stopping
 #TODO: checkpointing?
 
+# Parsed model files, keyed by path and holding (mtime, size, configuration)
+_YAML_CACHE: 'OrderedDict[str, Tuple[float, int, dict]]' = OrderedDict()
+_YAML_CACHE_SIZE = 100
+
+
+def _write_atomic(filename: str, contents: str) -> None:
+    """ Write a file so that concurrent readers never see it half-written """
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(contents)
+        os.replace(tmp_name, filename)
+    except OSError:
+        os.unlink(tmp_name)
+        raise
+
+
+def _load_model_config(model_file: str) -> dict:
+    """
+    Load a yaml model file and return its configuration. The configuration is
+    cached in memory and as json in a sibling .cache.json file, so the yaml is
+    only parsed once for as long as its mtime and size are unchanged. The
+    returned configuration is shared and must not be modified.
+    """
+    path = os.path.abspath(model_file)
+    stat = os.stat(path)
+    cached = _YAML_CACHE.get(path)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        _YAML_CACHE.move_to_end(path)
+        return cached[2]
+    json_file = path + '.cache.json'
+    # the cache file records the mtime and size of the yaml it was made from
+    source = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    configuration = None
+    if os.path.exists(json_file):
+        # the cache is only an optimisation, an unreadable one is treated as a miss
+        try:
+            with open(json_file, 'r') as model_file_json:
+                cache = json.load(model_file_json)
+            if isinstance(cache, dict) and cache.get('source') == source:
+                configuration = cache['configuration']
+        except (OSError, ValueError, KeyError):
+            logging.warning("Ignoring unreadable model cache file %s", json_file)
+    if configuration is None:
+        with open(path, 'r') as model_file_yaml:
+            configuration = yaml.load(model_file_yaml.read(), Loader=YLoader)
+        try:
+            _write_atomic(json_file, json.dumps({'source': source, 'configuration': configuration}, indent=2))
+        except OSError:
+            logging.warning("Could not write model cache file %s", json_file)
+    _YAML_CACHE[path] = (stat.st_mtime, stat.st_size, configuration)
+    if len(_YAML_CACHE) > _YAML_CACHE_SIZE:
+        _YAML_CACHE.popitem(last=False)
+    return configuration
+
+
+PRECISION_POLICIES = {'fp32': 'float32',
+                      'mixed_float16': 'mixed_float16',
+                      'mixed_bfloat16': 'mixed_bfloat16',
+                     }
+
+
+def _get_precision_policy(precision: str) -> str:
+    """ Map the precision parameter to a Keras dtype policy name """
+    if precision not in PRECISION_POLICIES:
+        raise ValueError("Unknown precision %s" % precision)
+    return PRECISION_POLICIES[precision]
+
+
+def _set_layer_policies(layers: list, policy: str) -> None:
+    """
+    Set the dtype policy of serialised layers, as model files store an explicit
+    float32 dtype for each layer which would override the global policy
+    """
+    for layer in layers:
+        if layer['class_name'] != 'InputLayer':
+            layer['config']['dtype'] = policy
+
+
+def _apply_precision(configuration: dict, policy: str) -> dict:
+    """ Return the model configuration with all layers using policy, except the outputs which stay in float32 """
+    if policy == 'float32':
+        return configuration
+    configuration = copy.deepcopy(configuration)
+    layers = configuration['config']['layers']
+    _set_layer_policies(layers, policy)
+    # softmax and losses are not numerically stable in half precision
+    output_names = {output[0] for output in configuration['config']['output_layers']}
+    _set_layer_policies([layer for layer in layers if layer['name'] in output_names], 'float32')
+    return configuration
+
+
+# Per-layer weights read from HDF5 files, keyed by path and holding (mtime, weights)
+_WEIGHTS_CACHE: 'OrderedDict[str, Tuple[float, List[List[np.ndarray]]]]' = OrderedDict()
+_WEIGHTS_CACHE_SIZE = 10
+
+
+def _decode(name) -> str:
+    return name.decode('utf8') if isinstance(name, bytes) else name
+
+
+def _read_h5_weights(filename: str) -> Optional[List[List[np.ndarray]]]:
+    """
+    Read the weights of every layer in a Keras HDF5 weights or model file, in file order.
+    Returns None if the file doesn't have the layer_names layout.
+    """
+    with h5py.File(filename, 'r') as h5_file:
+        group = h5_file['model_weights'] if 'model_weights' in h5_file else h5_file
+        if 'layer_names' not in group.attrs:
+            return None
+        layer_weights = []
+        for layer_name in group.attrs['layer_names']:
+            layer_group = group[_decode(layer_name)]
+            weight_names = [_decode(name) for name in layer_group.attrs['weight_names']]
+            if weight_names:
+                layer_weights.append([np.asarray(layer_group[name]) for name in weight_names])
+    return layer_weights
+
+
+def _load_weights(model: tf.keras.Model, filename: str) -> None:
+    """
+    Load weights into a model. HDF5 files are only read once while unchanged,
+    further loads set the cached arrays directly.
+    """
+    if not filename.endswith(('.h5', '.hdf5')):
+        model.load_weights(filename)
+        return
+    path = os.path.abspath(filename)
+    mtime = os.stat(path).st_mtime
+    cached = _WEIGHTS_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        _WEIGHTS_CACHE.move_to_end(path)
+        layer_weights = cached[1]
+    else:
+        read_weights = _read_h5_weights(path)
+        if read_weights is None:
+            model.load_weights(filename)
+            return
+        layer_weights = read_weights
+        _WEIGHTS_CACHE[path] = (mtime, layer_weights)
+        if len(_WEIGHTS_CACHE) > _WEIGHTS_CACHE_SIZE:
+            _WEIGHTS_CACHE.popitem(last=False)
+    layers = [layer for layer in model.layers if layer.weights]
+    if len(layers) != len(layer_weights):
+        raise ValueError("Weights file %s has %d layers with weights, the model has %d" %
+                         (filename, len(layer_weights), len(layers)))
+    assignments = []
+    for layer, values in zip(layers, layer_weights):
+        # the order Keras writes weights in, which isn't always the order of layer.weights
+        weights = layer.trainable_weights + layer.non_trainable_weights
+        if len(weights) != len(values):
+            raise ValueError("Layer %s has %d weights, but %d were saved for it in %s" %
+                             (layer.name, len(weights), len(values), filename))
+        assignments.extend(zip(weights, values))
+    tf.keras.backend.batch_set_value(assignments)
+
+
+def _schedule_lookup(thresholds: list, epoch: int):
+    """ Find the last threshold reached by epoch in an ascending list, or None """
+    index = bisect.bisect_right(thresholds, epoch) - 1
+    return thresholds[index] if index >= 0 else None
+
+
+def _deserialize_optimizer(opt_params: dict):
+    """
+    Create a new optimizer from its spec, returning it with the sorted epoch
+    thresholds of its learning rate schedule (None if the learning rate is fixed)
+    """
+    # only the config is modified, the rest can be shared with the original params
+    conf = dict(opt_params, config=dict(opt_params['config']))
+    lr_thresholds = None
+    if isinstance(conf['config']['learning_rate'], dict):
+        lr = conf['config']['learning_rate']
+        lr_thresholds = sorted(lr.keys())
+        conf['config']['learning_rate'] = lr[lr_thresholds[0]]
+    return tf.keras.optimizers.deserialize(conf), lr_thresholds
+
+
+def _is_xla_error(error: tf.errors.OpError) -> bool:
+    """ Whether an error was raised because XLA could not compile the graph """
+    return 'XLA' in error.message or 'JIT compilation' in error.message
+
 
 class OptimizerSchedulerCallback(tf.keras.callbacks.Callback):
 
@@ -39,39 +227,46 @@ class OptimizerSchedulerCallback(tf.keras.callbacks.Callback):
         self.optimizer_schedule = optimizer_schedule
 
     def on_epoch_end(self, epoch, logs=None):
-        """ Callback to stop training and change the optimizer """
-        epoch_keys = self.optimizer_schedule.params.keys()
-        if epoch + 1 in epoch_keys:
-            optimizer = self.optimizer_schedule[epoch+1]
-            self.model.compile(optimizer, loss=self.model.loss, metrics=self.model.metrics)
+        """
+        Callback to change the optimizer. Learning rate changes are handled by the
+        LearningRateScheduler, so this only swaps the optimizer and retraces the
+        train function instead of recompiling the model.
+        """
+        optimizer = self.optimizer_schedule[epoch+1]
+        if optimizer is self.model.optimizer:
+            return
+        self.model.optimizer = optimizer
+        if hasattr(optimizer, 'build'):
+            optimizer.build(self.model.trainable_variables)
+        self.model.make_train_function(force=True)
 
 
 class OptimizerSchedule:
     """ Schedules Optimizers and Learning Rates according to config """
-    def __init__(self, params, epochs: int):
-        """ Create an optimizer from params and learning rate """
-        self.params = copy.deepcopy(params)
+    def __init__(self, params, epochs: int, loss_scale: bool=False):
+        """
+        Create an optimizer from params and learning rate, wrapped for dynamic
+        loss scaling if training in float16
+        """
         self.optimizers = {}
         self.epochs = epochs
-        if 'class_name' in self.params: # Force this to be an epoch schedule even if it's not
-            self.params = {0: self.params}
+        if 'class_name' in params: # Force this to be an epoch schedule even if it's not
+            params = {0: params}
+        self.params = dict(params)
+        self._lr_thresholds = {}
         for thresh, opt_params in self.params.items():
-            conf = copy.deepcopy(opt_params)
-            if isinstance(conf['config']['learning_rate'], dict):
-                lr = conf['config']['learning_rate']
-                conf['config']['learning_rate'] = lr[min(lr.keys())]
-            self.optimizers[thresh] = tf.keras.optimizers.deserialize(conf)
-        self.lr_callback = tf.keras.callbacks.LearningRateScheduler(self._lr_scheduler)
-    
-    def _params_scheduler(self, epoch: int):
-        for thresh in sorted(self.params.keys(), reverse=True):
-            if epoch >= thresh:
-                return self.params[thresh]
+            self.optimizers[thresh], lr_thresholds = _deserialize_optimizer(opt_params)
+            if loss_scale:
+                self.optimizers[thresh] = tf.keras.mixed_precision.LossScaleOptimizer(self.optimizers[thresh])
+            if lr_thresholds:
+                self._lr_thresholds[thresh] = lr_thresholds
+        self._thresholds = sorted(self.params.keys())
+        self.lr_callback = tf.keras.callbacks.LearningRateScheduler(self.learning_rate)
 
     def _opt_scheduler(self, epoch: int):
-        for thresh in sorted(self.optimizers.keys(), reverse=True):
-            if epoch >= thresh:
-                return self.optimizers[thresh]
+        thresh = _schedule_lookup(self._thresholds, epoch)
+        if thresh is not None:
+            return self.optimizers[thresh]
     
     def __getitem__(self, epoch: int):
         """
@@ -80,16 +275,15 @@ class OptimizerSchedule:
         """ 
         return self._opt_scheduler(epoch)
 
-    def _lr_scheduler(self, epoch: int):
-        #TODO: use sorting
-        lr = None
-        params = self._params_scheduler(epoch)
-        if isinstance(params['config']['learning_rate'], dict):
-            for thresh, value in params['config']['learning_rate'].items():
-                if epoch >= thresh:
-                    lr = value
-        else:
-            lr = params['config']['learning_rate']
+    def learning_rate(self, epoch: int):
+        """ The scheduled learning rate for an epoch, or None before the first threshold """
+        thresh = _schedule_lookup(self._thresholds, epoch)
+        if thresh is None:
+            return None
+        lr = self.params[thresh]['config']['learning_rate']
+        if thresh in self._lr_thresholds:
+            lr_thresh = _schedule_lookup(self._lr_thresholds[thresh], epoch)
+            return lr[lr_thresh] if lr_thresh is not None else None
         return lr
 
     def get_callbacks(self, loss, metrics):
@@ -114,72 +308,197 @@ class Model:
         else:
             self.model_yaml = model_yaml
         '''
-        with open(params.model_file, 'r') as model_file:
-            configuration = yaml.load(model_file.read(), Loader=YLoader)
-        
-        self.model_json = json.dumps(configuration, indent=2)
-        self._model = tf.keras.models.model_from_json(self.model_json)
-
-        if params.model_weights:
-            self._model.load_weights(params.model_weights)
-        self.optimizer = optimizer or params.optimizer
-        self._optimizer_schedule = OptimizerSchedule(self.optimizer, self.params.epochs)
+        self._precision_policy = _get_precision_policy(params.precision)
+        tf.keras.mixed_precision.set_global_policy(self._precision_policy)
+        self._configuration: Optional[dict] = _apply_precision(_load_model_config(params.model_file),
+                                                               self._precision_policy)
+        self._model_json: Optional[str] = None
+        if params.multi_gpu:
+            logging.warning("!!! WARNING - EXPERIMENTAL !!! running on multi gpu")
+            # multi_gpu is either the number of gpus to use, or true for all of them
+            devices = None if params.multi_gpu is True else [f"/gpu:{i}" for i in range(params.multi_gpu)]
+            self._strategy = tf.distribute.MirroredStrategy(devices)
+        else:
+            self._strategy = tf.distribute.get_strategy()
+        # variables must be created in the strategy scope to be mirrored
+        with self._strategy.scope():
+            # the cached configuration is shared, so Keras gets a copy it is free to modify
+            self._model = tf.keras.models.model_from_config(copy.deepcopy(self._configuration))
+            if params.model_weights:
+                _load_weights(self._model, params.model_weights)
+            self.optimizer = optimizer or params.optimizer
+            self._optimizer_schedule = self._create_optimizer_schedule()
         self._loss = tf.keras.losses.deserialize(params.loss)
         self.params = params
         self._training_metrics = ['accuracy']
+        self._jit_compile = params.xla
+        self.img_gen = None
+        self._inference_fns: Dict[str, Any] = {}
+
+    def _create_optimizer_schedule(self) -> OptimizerSchedule:
+        """ Create a new schedule of optimizers, which must happen in the strategy scope """
+        return OptimizerSchedule(self.optimizer, self.params.epochs,
+                                 loss_scale=self._precision_policy == 'mixed_float16')
 
     def inject_layers(self, additional_layers, predecessor):
         """ Add k layers in position P """
         model_config = self._model.get_config()
-        new_layers = []
+        if predecessor not in {layer['name'] for layer in model_config['layers']}:
+            raise ValueError("Cannot inject layers after %s, no layer has that name" % predecessor)
         inject_uuid = uuid.uuid1()
+        # using PREDECESSOR to refer to the predecessor layer is a convention
+        replacement_mappings = {'PREDECESSOR': predecessor}
+        for i, new_layer in enumerate(additional_layers):
+            replacement_mappings[new_layer['name']] = f"autogenerated-{new_layer['name']}-{inject_uuid}-{i}"
+        injected_layers = copy.deepcopy(additional_layers)
+        for new_layer in injected_layers:
+            new_name = replacement_mappings[new_layer['name']]
+            new_layer['name'] = new_name
+            new_layer['config']['name'] = new_name
+            if self._precision_policy != 'float32':
+                new_layer['config']['dtype'] = self._precision_policy
+            # this is delicate: we need to make sure that all the layers are connected
+            # with their new autogenerated names
+            new_layer['inbound_nodes'] = tp.utils.replace_inbound_layer(
+                new_layer['inbound_nodes'], replacement_mappings
+            )
+        last_new_layer = injected_layers[-1]['name']
+        new_layers = []
         inserted = False
         for layer in model_config['layers']:
-            if not inserted:
-                new_layers.append(layer)
-                if layer['name'] == predecessor:
-                    # using PREDECESSOR to refer to the predecessor layer is a convention
-                    replacement_mappings = {'PREDECESSOR': predecessor}
-                    for i, new_layer in enumerate(copy.deepcopy(additional_layers)):
-                        new_name = f"autogenerated-{new_layer['name']}-{inject_uuid}-{i}"
-                        replacement_mappings[new_layer['name']] = new_name
-                        new_layer['name'] = new_name
-                        new_layer['config']['name'] = new_name
-                        # this is delicate: we need to make sure that all the layers are connected
-                        # with their new autogenerated names
-                        for replace_old, replace_new in replacement_mappings.items():
-                            new_layer['inbound_nodes'] = tp.utils.replace_inbound_layer(
-                                new_layer['inbound_nodes'], replace_old, replace_new
-                            )
-                        new_layers.append(new_layer)
-                        last_new_layer = new_layer['name']
-                    inserted = True
-            else:
-                layer['inbound_nodes'] = tp.utils.replace_inbound_layer(layer['inbound_nodes'], predecessor, last_new_layer)
-                new_layers.append(layer)
+            if inserted:
+                layer['inbound_nodes'] = tp.utils.replace_inbound_layer(layer['inbound_nodes'],
+                                                                        {predecessor: last_new_layer})
+            new_layers.append(layer)
+            if layer['name'] == predecessor:
+                new_layers.extend(injected_layers)
+                inserted = True
         model_config['layers'] = new_layers
-        self._model = tf.keras.Model.from_config(model_config)
+        with self._strategy.scope():
+            try:
+                self._model = self._rewire(model_config, {layer['name'] for layer in injected_layers})
+            except ValueError:
+                # layers after the injection point can't take inputs of a new shape,
+                # they have to be rebuilt from scratch
+                self._model = tf.keras.Model.from_config(model_config)
+        self._inference_fns = {}
         
         # CHANGE: json-yaml switch
         # self.model_yaml = self._model.to_yaml()
-        self.model_json = self._model.to_json()
+        # the json is now serialised from the new model when needed
+        self._configuration = None
+        self._model_json = None
         
         return last_new_layer
 
+    @property
+    def model_json(self) -> str:
+        """ The model architecture as json, only serialised when first needed """
+        if self._model_json is None:
+            if self._configuration is None:
+                self._model_json = self._model.to_json()
+            else:
+                self._model_json = json.dumps(self._configuration, separators=(',', ':'))
+        return self._model_json
+
+    def _rewire(self, model_config, new_layer_names):
+        """
+        Build a functional model from a config by calling the existing layers, so that
+        they keep their weights, and only creating the layers in new_layer_names.
+        Raises ValueError if the config can't be rewired this way: shared or multi-output
+        layers, layers listed before their inputs, tensors passed as call arguments,
+        or existing layers that can't take their new inputs.
+        """
+        tensors = {input_layer[0]: tensor
+                   for input_layer, tensor in zip(model_config['input_layers'], self._model.inputs)}
+        for layer_config in model_config['layers']:
+            if layer_config['class_name'] == 'InputLayer':
+                continue
+            if len(layer_config['inbound_nodes']) != 1:
+                raise ValueError("Layer %s is shared, can't rewire it" % layer_config['name'])
+            inbound = layer_config['inbound_nodes'][0]
+            for inbound_layer in inbound:
+                if inbound_layer[0] not in tensors:
+                    raise ValueError("Layer %s comes before its input %s, can't rewire it" %
+                                     (layer_config['name'], inbound_layer[0]))
+                if inbound_layer[1] != 0 or inbound_layer[2] != 0:
+                    raise ValueError("Layer %s takes a secondary output of %s, can't rewire it" %
+                                     (layer_config['name'], inbound_layer[0]))
+            call_kwargs = inbound[0][3] if len(inbound[0]) > 3 else {}
+            # tensor arguments are serialised as nested references to other layers
+            if not all(isinstance(value, (bool, int, float, str, type(None))) for value in call_kwargs.values()):
+                raise ValueError("Layer %s has non-scalar call arguments, can't rewire it" % layer_config['name'])
+            if layer_config['name'] in new_layer_names:
+                layer = tf.keras.layers.deserialize({'class_name': layer_config['class_name'],
+                                                     'config': dict(layer_config['config'])})
+            else:
+                layer = self._model.get_layer(layer_config['name'])
+            inputs = [tensors[inbound_layer[0]] for inbound_layer in inbound]
+            output = layer(inputs[0] if len(inputs) == 1 else inputs, **call_kwargs)
+            if isinstance(output, (list, tuple)):
+                raise ValueError("Layer %s has multiple outputs, can't rewire it" % layer_config['name'])
+            tensors[layer_config['name']] = output
+        outputs = [tensors[output_layer[0]] for output_layer in model_config['output_layers']]
+        return tf.keras.Model(inputs=self._model.inputs,
+                              outputs=outputs[0] if len(outputs) == 1 else outputs,
+                              name=model_config['name'])
+
     def copy_weights(self, other_model, early_stop=False):
-        """ Copy weights from another model, up to the last layer with the same name """
-        for this_layer, other_layer in zip(self._model.layers, other_model._model.layers):
-            if this_layer.name != other_layer.name:
+        """
+        Copy weights from another model into the layers with the same name and weight shapes,
+        optionally stopping at the first layer that doesn't have a match
+        """
+        other_layers = {layer.name: layer for layer in other_model._model.layers}
+        assignments = []
+        for this_layer in self._model.layers:
+            other_layer = other_layers.get(this_layer.name)
+            if other_layer is None or \
+                    [w.shape for w in this_layer.weights] != [w.shape for w in other_layer.weights]:
                 if early_stop:
                     break
                 else:
                     continue
-            this_layer.set_weights(other_layer.get_weights())
+            assignments.extend(zip(this_layer.weights, other_layer.get_weights()))
+        tf.keras.backend.batch_set_value(assignments)
 
     def fit(self, data: tp.data.Dataset, epochs=None, verbose=None, log_wandb:bool=False,
             adversarial_testing:bool=False, tensorboard=False):
         """ Train a model """
         start_time = time.perf_counter()
+        initial_weights = self._model.get_weights() if self._jit_compile else None
+        try:
+            self._fit(data, epochs, verbose, log_wandb, tensorboard, jit_compile=self._jit_compile)
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as error:
+            if not self._jit_compile or not _is_xla_error(error):
+                raise
+            logging.warning("XLA compilation failed for this model, falling back to non-XLA training")
+            # start again from the untrained weights and fresh optimizers
+            self._model.set_weights(initial_weights)
+            with self._strategy.scope():
+                self._optimizer_schedule = self._create_optimizer_schedule()
+            self._jit_compile = False
+            self._inference_fns = {}
+            self._fit(data, epochs, verbose, log_wandb, tensorboard, jit_compile=False)
+        end_time = time.perf_counter()
+        logging.info('Model trained for %.2fm' % ((end_time - start_time) / 60.))
+        self.test_metrics = self.evaluate(data.get_testing_handle(), adversarial=adversarial_testing)
+        if log_wandb:
+            for metric, value in self.test_metrics.items():
+                # for some reason MyPy doesn't understand this module well
+                wandb.run.summary[metric] = value  # type: ignore
+
+    def _fit(self, data: tp.data.Dataset, epochs, verbose, log_wandb:bool, tensorboard:bool,
+             jit_compile:bool):
+        """ Compile and run the training loop """
+        logging.info("Training with XLA %s" % ("enabled" if jit_compile else "disabled"))
+        self.img_gen = data.img_gen
+        if self.params.fast_train and self.params.multi_gpu:
+            logging.warning("fast_train is not supported on multi gpu, using Keras fit")
+        elif self.params.fast_train:
+            if log_wandb or tensorboard or self.params.reduce_lr_on_plateau:
+                logging.warning("fast_train does not use callbacks, ignoring wandb, tensorboard and reduce_lr_on_plateau")
+            self._fit_fast(data, epochs or self.params.epochs, jit_compile)
+            return
         callbacks = self._optimizer_schedule.get_callbacks(self._loss,
                                                            self._training_metrics)
         if self.params.reduce_lr_on_plateau:
@@ -189,15 +508,13 @@ class Model:
             callbacks.append(wandb.keras.WandbCallback())
         if tensorboard:
             callbacks.append(tf.keras.callbacks.TensorBoard(log_dir=self.params.tb_log_dir))
-        if self.params.multi_gpu:
-            logging.warning("!!! WARNING - EXPERIMENTAL !!! running on multi gpu")
-            tf.keras.utils.multi_gpu_model(self._model, gpus=self.params.multi_gpu)
-        self.img_gen = data.img_gen
-        self._model.compile(
-            optimizer = self._optimizer_schedule[0],
-            loss = self._loss,
-            metrics = self._training_metrics,
-            )
+        with self._strategy.scope():
+            self._model.compile(
+                optimizer = self._optimizer_schedule[0],
+                loss = self._loss,
+                metrics = self._training_metrics,
+                jit_compile = jit_compile,
+                )
         self._model.fit(
             data.get_training_handle(),
             epochs = epochs or self.params.epochs,
@@ -207,31 +524,172 @@ class Model:
             verbose = verbose or self.params.verbose,
             validation_data = data.get_validation_handle(standardized=True),
             )
-        end_time = time.perf_counter()
-        logging.info('Model trained for %.2fm' % ((end_time - start_time) / 60.))
-        self.test_metrics = self.evaluate(data.get_testing_handle(), adversarial=adversarial_testing)
-        if log_wandb:
-            for metric, value in self.test_metrics.items():
-                # for some reason MyPy doesn't understand this module well
-                wandb.run.summary[metric] = value  # type: ignore
+
+    def _make_train_fn(self, optimizer, jit_compile:bool):
+        """
+        Trace a function that runs up to n_steps training steps on batches from an iterator,
+        so that the Python dispatch overhead is only paid once every n_steps. It returns
+        the last loss and the number of steps run, which is less than n_steps if the
+        iterator ran out.
+        """
+        model = self._model
+        loss_fn = self._loss
+        loss_scale = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
+
+        @tf.function(jit_compile=jit_compile)
+        def train_step(x, y):
+            with tf.GradientTape() as tape:
+                # Keras loss functions return per-example losses, average them as fit does
+                loss = tf.reduce_mean(loss_fn(y, model(x, training=True)))
+                if model.losses:
+                    loss += tf.add_n(model.losses)
+                scaled_loss = optimizer.get_scaled_loss(loss) if loss_scale else loss
+            gradients = tape.gradient(scaled_loss, model.trainable_variables)
+            if loss_scale:
+                gradients = optimizer.get_unscaled_gradients(gradients)
+            optimizer.apply_gradients(zip(gradients, model.trainable_variables))
+            return loss
+
+        # the iterator can't be compiled by XLA, so only the inner step is
+        @tf.function
+        def train_steps(iterator, n_steps):
+            loss = tf.constant(0.)
+            steps = tf.constant(0)
+            for _ in tf.range(n_steps):
+                batch = iterator.get_next_as_optional()
+                if not batch.has_value():
+                    break
+                x, y = batch.get_value()
+                loss = train_step(x, y)
+                steps += 1
+            return loss, steps
+
+        return train_steps
+
+    def _fit_fast(self, data: tp.data.Dataset, epochs:int, jit_compile:bool):
+        """ Train with a custom training loop instead of Keras fit, without callbacks or validation """
+        # only set for endless augmented datasets, the others are iterated until they run out
+        steps_per_epoch = data.steps_per_epoch['train']
+        chunk = self.params.fast_train_steps
+        train_fns: Dict[int, Any] = {}
+        dataset = data.get_training_handle()
+        for epoch in range(epochs):
+            optimizer = self._optimizer_schedule[epoch]
+            optimizer.learning_rate = self._optimizer_schedule.learning_rate(epoch)
+            if id(optimizer) not in train_fns:
+                train_fns[id(optimizer)] = self._make_train_fn(optimizer, jit_compile)
+            train_fn = train_fns[id(optimizer)]
+            iterator = iter(dataset)
+            step = 0
+            epoch_loss = None
+            while steps_per_epoch is None or step < steps_per_epoch:
+                n_steps = chunk if steps_per_epoch is None else min(chunk, steps_per_epoch - step)
+                loss, steps = train_fn(iterator, tf.constant(n_steps))
+                steps = int(steps)
+                if steps > 0:
+                    epoch_loss = float(loss)
+                step += steps
+                if steps < n_steps:
+                    break
+            logging.info("Epoch %d/%d - %d steps - loss: %s" % (epoch + 1, epochs, step,
+                         "%.4f" % epoch_loss if epoch_loss is not None else "n/a"))
 
     def evaluate(self, test_data, adversarial:bool=False):
         """ Evaluate model on some test data handle """
         return tp.metrics.evaluate(self, test_data, adversarial_gradient_source=self if adversarial else None)
 
-    def predict_proba(self, X):
+    def _input_spec(self) -> tf.TensorSpec:
+        """ Input signature of the model, with an unbounded batch size """
+        return tf.TensorSpec(shape=(None,) + tuple(self._model.input_shape[1:]), dtype=self._model.input.dtype)
+
+    def _get_inference_fn(self, name: str, output_fn):
+        """
+        Lazily trace an inference graph applying output_fn to the model output,
+        with an unbounded batch size to avoid retracing
+        """
+        if name not in self._inference_fns:
+            model = self._model
+            input_spec = self._input_spec()
+            # outputs are cast back to float32 in case they come from a lower precision layer
+            self._inference_fns[name] = tf.function(
+                lambda x: output_fn(tf.cast(model(x, training=False), tf.float32)),
+                input_signature=[input_spec],
+                jit_compile=self._jit_compile)
+        return self._inference_fns[name]
+
+    def _empty_outputs(self, name: str, output_fn, n: int) -> np.ndarray:
+        """ Allocate the outputs of an inference function for n examples """
+        output_spec = self._get_inference_fn(name, output_fn).get_concrete_function().structured_outputs
+        return np.empty((n,) + tuple(output_spec.shape[1:]), dtype=output_spec.dtype.as_numpy_dtype)
+
+    def _run_inference(self, name: str, output_fn, X, already_standardized:bool=False):
+        """
+        Stream X through an inference function in batches. X is either an array-like, or a
+        batched tf.data.Dataset of inputs or (inputs, labels)
+        """
+        if isinstance(X, tf.data.Dataset):
+            outputs = [self._run_batch(name, output_fn, batch, standardize=not already_standardized)
+                       for batch in X]
+            return np.concatenate(outputs) if outputs else self._empty_outputs(name, output_fn, 0)
+        X = np.asarray(X)
+        if self.img_gen and not already_standardized:
+            X = self.img_gen.standardize(np.copy(X))
+        outputs = self._empty_outputs(name, output_fn, len(X))
+        batches = tf.data.Dataset.from_tensor_slices(X) \
+                                 .batch(self.params.batch_size) \
+                                 .prefetch(tf.data.AUTOTUNE)
+        offset = 0
+        for batch in batches:
+            output = self._run_batch(name, output_fn, batch)
+            outputs[offset:offset + output.shape[0]] = output
+            offset += output.shape[0]
+        return outputs
+
+    def _run_batch(self, name: str, output_fn, batch, standardize:bool=False):
+        """ Run an inference function on a single batch, falling back to non-XLA if it can't be compiled """
+        if isinstance(batch, tuple):
+            batch = batch[0]
+        if standardize and self.img_gen:
+            batch = self.img_gen.standardize(np.copy(batch))
+        batch = tf.cast(batch, self._model.input.dtype)
+        try:
+            return self._get_inference_fn(name, output_fn)(batch).numpy()
+        except (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError) as error:
+            if not self._jit_compile or not _is_xla_error(error):
+                raise
+            logging.warning("XLA compilation failed for this model, falling back to non-XLA inference")
+            self._jit_compile = False
+            self._inference_fns = {}
+            return self._get_inference_fn(name, output_fn)(batch).numpy()
+
+    def predict_proba(self, X, already_standardized:bool=False):
         """ Output logits """
-        if self.img_gen:
-            X = self.img_gen.standardize(X)
-        return self._model.predict(X)
+        return self._run_inference('proba', lambda y: y, X, already_standardized)
 
-    def predict_classes(self, X):
-        """ Aggregated argmax """
-        return np.argmax(self.predict_proba(X), axis = 1)
+    def predict_classes(self, X, already_standardized:bool=False):
+        """
+        Aggregated argmax, computed on device so only the class indices are copied back
+        and the full logits are never held in memory
+        """
+        argmax = lambda y: tf.argmax(y, axis=1, output_type=tf.int32)
+        return self._run_inference('classes', argmax, X, already_standardized)
 
-    def save(self, filename):
-        """ Train a model """
-        self._model.save(filename)
+    def save(self, filename, inference_only:bool=False):
+        """
+        Save a model. If inference_only, save a SavedModel with just the weights and a
+        pre-traced serving signature, without optimizer state or training metadata.
+        """
+        if not inference_only:
+            self._model.save(filename)
+            return
+        model = self._model
+        serve = tf.function(lambda x: tf.cast(model(x, training=False), tf.float32),
+                            input_signature=[self._input_spec()])
+        # a bare module, so that only the weights are tracked and not the optimizer
+        module = tf.Module()
+        module.weights = list(model.weights)
+        module.serve = serve
+        tf.saved_model.save(module, filename, signatures={'serving_default': serve.get_concrete_function()})
 
     def get_keras_model(self):
         """ Return raw Keras model """
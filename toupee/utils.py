@@ -115,13 +115,9 @@ def log_metrics(metrics) -> None:
             logging.info(f"** Epsilon = {epsilon}")
             _log_metrics(metrics['adversarial'][epsilon])
 
-def replace_inbound_layer(layer_list, old_value, new_value):
-    new_list = []
-    for a in layer_list:
-        a_acc = []
-        for b in a:
-            new_b = b
-            b[0] = new_value if b[0] == old_value else b[0]
-            a_acc.append(new_b)
-        new_list.append(a_acc)
-    return new_list
\ No newline at end of file
+def replace_inbound_layer(layer_list, replacements: dict):
+    """ Rename the inbound layers of serialised nodes according to an {old_name: new_name} mapping """
+    for node in layer_list:
+        for inbound in node:
+            inbound[0] = replacements.get(inbound[0], inbound[0])
+    return layer_list
\ No newline at end of file